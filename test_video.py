@@ -4,222 +4,410 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import Gst, Gtk, Gdk, GLib
 from pathlib import Path
 import json
-from pprint import pprint
+import logging
+import os
+import signal
+import time
+
+# Debug output is off the hot path unless asked for, e.g. PAREIDOLIA_LOG=DEBUG
+logging.basicConfig(level=os.environ.get("PAREIDOLIA_LOG", "INFO").upper(), format="%(message)s")
+log = logging.getLogger("pareidolia")
 
 
 #-------------------------------
 # Load Clips Configuration
 #-------------------------------
-with open("clips.json", "r") as f:
-    clips_config = json.load(f)['clips']
+# Keys every clip must define; checked once at load so a bad entry fails at
+# startup instead of with a KeyError on its first trigger
+REQUIRED_CLIP_KEYS = ("name", "file_path", "start_sec")
 
-for c in clips_config:
-    #convert to URIs
-    if not Path(c['file_path']).exists():
-        raise FileNotFoundError(f"Clip file does not exist: {c['file_path']}. Note the presence of clip_download_helper.py to download missing files.")
-    c['file_path'] = str(Path(c['file_path']).resolve().as_uri())
-    pprint(c)
-    print("\n")
+def load_clips(config_path="clips.json"):
+    """
+    Read the clip list from config_path, resolve each file to a URI and
+    precompute the values the trigger path needs; returns the list of clips.
+    """
+    with open(config_path, "r") as f:
+        clips = json.load(f)['clips']
+
+    # Many clips are cut from the same video, so check and convert each file only once
+    file_uris = {}
+    for i, c in enumerate(clips):
+        missing = [key for key in REQUIRED_CLIP_KEYS if key not in c]
+        if missing:
+            raise ValueError(f"Clip {c.get('name', i)} in {config_path} is missing {', '.join(missing)}")
+        #convert to URIs
+        path = c['file_path']
+        if path not in file_uris:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Clip file does not exist: {path}. Note the presence of clip_download_helper.py to download missing files.")
+            file_uris[path] = Path(os.path.abspath(path)).as_uri()
+        c['file_path'] = file_uris[path]
+        # Precompute nanosecond times so show_clip and the loop handler don't redo the math per trigger
+        c['_start_ns'] = int(c['start_sec'] * Gst.SECOND)
+        end_sec = c.get('end_sec', -1)
+        c['_end_ns'] = int(end_sec * Gst.SECOND) if end_sec >= 0 else -1
+        log.debug("Loaded clip: %s", c)
+    return clips
+
+clips_config = load_clips()
 
 # -------------------------------
 # Initialize GStreamer
 # -------------------------------
+# GStreamer reads GST_DEBUG in Gst.init, so it has to be set before this point.
+# Default to errors only (0=none, 1=error, 2=warning, 3=info, 4=debug, 5=log);
+# export GST_DEBUG to see more.
+os.environ.setdefault('GST_DEBUG', '1')
 Gst.init(None)
 
-# Set debug level to see what's happening
-import os
-os.environ['GST_DEBUG'] = '2'  # 0=none, 1=error, 2=warning, 3=info, 4=debug, 5=log
+# Prefer the Raspberry Pi's V4L2 M2M hardware decoder over software avdec_h264.
+# playbin autoplugs by rank, so raising it is enough; missing factories are skipped.
+HW_DECODERS = ("v4l2h264dec",)
+
+def prefer_hardware_decoders():
+    registry = Gst.Registry.get()
+    for name in HW_DECODERS:
+        factory = registry.find_feature(name, Gst.ElementFactory)
+        if factory is not None:
+            factory.set_rank(Gst.Rank.PRIMARY + 1)
+            log.info("Preferring hardware decoder %s", name)
+
+prefer_hardware_decoders()
 
 # -------------------------------
 # GTK Window
 # -------------------------------
 win = Gtk.Window(title="Video Player")
 win.set_default_size(800, 600)
-win.connect("destroy", Gtk.main_quit)
 
 # -------------------------------
-# GStreamer Playbin with gtksink
+# GStreamer Playbins with GTK video sinks, one per video file
 # -------------------------------
-pipeline = Gst.ElementFactory.make("playbin", "player")
-pipeline.set_property("uri", clips_config[0].get('file_path', None))
-
-# gtksink automatically creates a GTK widget for video
-gtksink = Gst.ElementFactory.make("gtksink", "videosink")
-if not gtksink:
-    print("ERROR: Could not create gtksink, trying xvimagesink")
-    gtksink = Gst.ElementFactory.make("xvimagesink", "videosink")
-    
-pipeline.set_property("video-sink", gtksink)
+# Clips are visual-only local files: playbin only needs to build its video chain.
+# Leaving out audio/text and network-style buffering keeps it from autoplugging
+# decoders, queues and sinks that only delay the first frame.
+GST_PLAY_FLAG_VIDEO = 0x1
+
+def make_gl_sink(uri, index):
+    """
+    Build glsinkbin wrapping gtkglsink and add its widget to the stack as uri.
+    gtkglsink only creates its GL context once its widget is in a realized
+    window, so this probes the sink by taking it to READY; returns the sink
+    bin, or None if either element is missing or GL can't be set up.
+    """
+    videosink = Gst.ElementFactory.make("gtkglsink", f"videosink_{index}")
+    glsinkbin = Gst.ElementFactory.make("glsinkbin", f"glsinkbin_{index}")
+    if not videosink or not glsinkbin:
+        log.warning("Could not create gtkglsink/glsinkbin, falling back to gtksink")
+        return None
+    glsinkbin.set_property("sink", videosink)
+
+    video_widget = videosink.get_property("widget")
+    stack.add_named(video_widget, uri)
+    video_widget.show()
+    if glsinkbin.set_state(Gst.State.READY) == Gst.StateChangeReturn.FAILURE:
+        log.warning("Could not set up OpenGL for gtkglsink, falling back to gtksink")
+        glsinkbin.set_state(Gst.State.NULL)
+        stack.remove(video_widget)
+        return None
+    video_widget.set_can_focus(True)
+    return glsinkbin
+
+def make_player(uri, index):
+    """
+    Build a playbin for one video file with its own GTK video sink and add the
+    sink's widget to the stack as uri. Each file gets its own pipeline so
+    switching files never changes a URI or waits on a fresh preroll.
+    """
+    player = Gst.ElementFactory.make("playbin", f"player_{index}")
+    player.set_property("uri", uri)
+    player.set_property("buffer-duration", 0)
+    player.set_property("flags", GST_PLAY_FLAG_VIDEO)
+
+    # Prefer gtkglsink inside glsinkbin: decoded frames are uploaded to GL
+    # textures once and drawn by the widget, instead of being converted and
+    # copied through system memory by gtksink
+    glsinkbin = make_gl_sink(uri, index)
+    if glsinkbin:
+        player.set_property("video-sink", glsinkbin)
+        return player
+
+    # gtksink automatically creates a GTK widget for video
+    videosink = Gst.ElementFactory.make("gtksink", f"videosink_{index}")
+    if not videosink:
+        log.error("Could not create gtksink, trying xvimagesink")
+        videosink = Gst.ElementFactory.make("xvimagesink", f"videosink_{index}")
+    player.set_property("video-sink", videosink)
 
-# Get the GTK widget from gtksink
-video_widget = gtksink.get_property("widget")
-video_widget.set_can_focus(True)
-video_widget.grab_focus()
+    # Get the GTK widget from gtksink
+    video_widget = videosink.get_property("widget")
+    video_widget.set_can_focus(True)
+    stack.add_named(video_widget, uri)
+    video_widget.show()
+    return player
 
-win.add(video_widget)
+# Stack the video widgets so only the active file's output is shown. The window
+# is shown first so GL sinks have a realized toplevel when they are probed.
+stack = Gtk.Stack()
+win.add(stack)
 win.show_all()
 
-# Timer/loop state
-loop_timer_id = None
-CHECK_INTERVAL_MS = 100
+players = {}
+for i, uri in enumerate(dict.fromkeys(c['file_path'] for c in clips_config)):
+    players[uri] = make_player(uri, i)
+
+# The active playbin; starts on the first clip's file
+pipeline = players[clips_config[0]['file_path']]
+stack.set_visible_child_name(clips_config[0]['file_path'])
+stack.get_visible_child().grab_focus()
+
+# Loop state
+current_clip = None
+# Clip waiting for its pipeline to finish prerolling (see on_bus_message ASYNC_DONE)
+pending_clip = None
+# Enum values used on every trigger/loop, bound once instead of resolved through gi each time
+FORMAT_TIME = Gst.Format.TIME
+SEEK_SET = Gst.SeekType.SET
+STATE_PAUSED = Gst.State.PAUSED
+STATE_PLAYING = Gst.State.PLAYING
+CHANGE_FAILURE = Gst.StateChangeReturn.FAILURE
+CHANGE_ASYNC = Gst.StateChangeReturn.ASYNC
+SEEK_FLAGS = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SEGMENT
+# Loop re-seeks must not flush, so playback continues seamlessly at the loop point
+LOOP_SEEK_FLAGS = Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SEGMENT
+
+def seek_to_clip(clip, flags):
+    """
+    Segment seek to the clip's start, bounded by end_sec (or the end of the file
+    when end_sec == -1, since _end_ns is then -1 / CLOCK_TIME_NONE). GStreamer
+    posts SEGMENT_DONE exactly at the end instead of us polling the position,
+    and the pipeline never goes to EOS.
+    """
+    return pipeline.seek(
+        1.0, FORMAT_TIME, flags,
+        SEEK_SET, clip['_start_ns'],
+        SEEK_SET, clip['_end_ns']
+    )
 
 def show_clip(clip):
     """
-    Seek to start of clip and play it. If end_sec >= 0, install a GLib timeout
-    that checks position and loops back to start when end is reached. If end_sec
-    == -1, play indefinitely and remove any existing loop timer.
+    Seek to start of clip and play it. The seek is a segment seek and
+    on_bus_message loops back to start on SEGMENT_DONE, either at end_sec or,
+    if end_sec == -1, at the end of the file.
+
+    If the clip is in a different file, the current playbin is parked in PAUSED
+    and the clip file's prerolled playbin becomes the active one. If that
+    playbin still has to preroll, the clip is left pending and started from
+    on_bus_message on ASYNC_DONE instead of blocking the main loop. A clip in
+    the file that is already playing is seeked to directly.
     """
-    global loop_timer_id
+    global pipeline, pending_clip
 
-    print(f"\n=== show_clip called for '{clip['name']}' ===")
-    
-    # Stop and remove existing loop timer if present
-    if loop_timer_id is not None:
-        print("  Removing existing loop timer")
-        try:
-            GLib.source_remove(loop_timer_id)
-        except Exception as e:
-            print(f"  Error removing timer: {e}")
-        loop_timer_id = None
-
-    # If the clip points to a different file, update the pipeline URI
-    clip_uri = clip['file_path']
-    current_uri = pipeline.get_property('uri')
+    log.debug("=== show_clip called for '%s' ===", clip['name'])
     
-    print(f"  Current URI: {current_uri}")
-    print(f"  Target URI:  {clip_uri}")
+    player = players[clip['file_path']]
     
-    # Get current state
-    ret, state, pending = pipeline.get_state(0)
-    print(f"  Current pipeline state: {state.value_nick}, pending: {pending.value_nick}")
+    # Get current state (only needed for the debug log)
+    if log.isEnabledFor(logging.DEBUG):
+        ret, state, pending = player.get_state(0)
+        log.debug("  Target pipeline: %s (%s)", player.get_name(), clip['file_path'])
+        log.debug("  Target pipeline state: %s, pending: %s", state.value_nick, pending.value_nick)
     
-    # If changing files, need to stop, change URI, then start again
-    if clip_uri != current_uri:
-        print("  URI changed - resetting pipeline")
-        pipeline.set_state(Gst.State.READY)
-        ret, state, pending = pipeline.get_state(Gst.CLOCK_TIME_NONE)
-        print(f"  After READY: {state.value_nick}")
-        
-        pipeline.set_property('uri', clip_uri)
-        print("  URI property updated")
-
-    # Set to PAUSED state and wait for it to be ready
-    print("  Setting to PAUSED")
-    pipeline.set_state(Gst.State.PAUSED)
-    ret, state, pending = pipeline.get_state(5 * Gst.SECOND)  # 5 second timeout
-    print(f"  After PAUSED: ret={ret.value_nick}, state={state.value_nick}, pending={pending.value_nick}")
+    # Retriggering within the file that is already playing: a flushing seek
+    # works in PLAYING, so skip the PAUSED round-trip
+    if player is pipeline and current_clip is not None and pending_clip is None:
+        start_clip(clip)
+        log.debug("=== show_clip complete ===")
+        return
+
+    # If changing files, park the old playbin and show the new one
+    if player is not pipeline:
+        log.debug("  File changed - switching from %s", pipeline.get_name())
+        pipeline.set_state(STATE_PAUSED)
+        stack.set_visible_child_name(clip['file_path'])
+        pipeline = player
+
+    # Set to PAUSED state; seek right away if it's already prerolled
+    log.debug("  Setting to PAUSED")
+    ret = pipeline.set_state(STATE_PAUSED)
+    log.debug("  After PAUSED: ret=%s", ret.value_nick)
     
-    if ret == Gst.StateChangeReturn.FAILURE:
-        print("  ERROR: Failed to pause pipeline!")
+    if ret == CHANGE_FAILURE:
+        log.error("Failed to pause pipeline for clip '%s'", clip['name'])
+        return
+    if ret == CHANGE_ASYNC:
+        log.debug("  Waiting for preroll before seeking")
+        pending_clip = clip
         return
     
-    start_ns = int(clip['start_sec'] * Gst.SECOND)
-    end_sec = clip.get('end_sec', -1)
-    end_ns = int(end_sec * Gst.SECOND) if end_sec >= 0 else -1
+    start_clip(clip)
+    log.debug("=== show_clip complete ===")
 
-    print(f"  Seeking to {start_ns / Gst.SECOND}s")
+def start_clip(clip):
+    """Seek the active, prerolled pipeline to the clip and set it PLAYING."""
+    global current_clip, pending_clip
+
+    pending_clip = None
+    log.debug("  Seeking to %ss", clip['start_sec'])
     
     # Now seek while in PAUSED state
-    success = pipeline.seek_simple(
-        Gst.Format.TIME,
-        Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-        start_ns
-    )
+    success = seek_to_clip(clip, SEEK_FLAGS)
     
-    print(f"  Seek result: {success}")
+    log.debug("  Seek result: %s", success)
     
     if success:
         # After successful seek, set to PLAYING
-        print("  Setting to PLAYING")
-        pipeline.set_state(Gst.State.PLAYING)
-        ret, state, pending = pipeline.get_state(1 * Gst.SECOND)
-        print(f"  After PLAYING: {state.value_nick}")
-        print(f"✓ Playing clip '{clip['name']}' from {clip['start_sec']}s to {clip.get('end_sec', 'end')}s")
+        log.debug("  Setting to PLAYING")
+        pipeline.set_state(STATE_PLAYING)
+        log.info("✓ Playing clip '%s' from %ss to %ss", clip['name'], clip['start_sec'], clip.get('end_sec', 'end'))
     else:
-        print(f"✗ Seek failed for clip '{clip['name']}'")
+        log.warning("✗ Seek failed for clip '%s'", clip['name'])
         # Try to play anyway
-        pipeline.set_state(Gst.State.PLAYING)
-
-    # If end_sec >= 0, install a timer to loop
-    if end_ns >= 0:
-        print(f"  Installing loop timer (check every {CHECK_INTERVAL_MS}ms)")
-        def check_loop():
-            # Query current position
-            success_pos, pos = pipeline.query_position(Gst.Format.TIME)
-            if success_pos:
-                if pos >= end_ns:
-                    print(f"  Loop: position {pos/Gst.SECOND}s >= end {end_ns/Gst.SECOND}s, seeking back")
-                    pipeline.seek_simple(
-                        Gst.Format.TIME,
-                        Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
-                        start_ns
-                    )
-            # Keep the timer running until explicitly removed
-            return True
-
-        loop_timer_id = GLib.timeout_add(CHECK_INTERVAL_MS, check_loop)
-    
-    print("=== show_clip complete ===\n")
+        pipeline.set_state(STATE_PLAYING)
+
+    current_clip = clip
+
+def on_bus_error(message):
+    err, debug = message.parse_error()
+    log.error("BUS ERROR: %s", err)
+    log.error("  Debug: %s", debug)
+
+def on_bus_warning(message):
+    err, debug = message.parse_warning()
+    log.warning("BUS WARNING: %s", err)
+
+def on_bus_eos(message):
+    log.debug("BUS: End of stream")
+
+def on_bus_state_changed(message):
+    if message.src in pipelines and log.isEnabledFor(logging.DEBUG):
+        old, new, pending = message.parse_state_changed()
+        log.debug("BUS: %s state: %s -> %s (pending: %s)", message.src.get_name(), old.value_nick, new.value_nick, pending.value_nick)
+
+def on_bus_async_done(message):
+    log.debug("BUS: ASYNC_DONE - pipeline is ready")
+    if message.src == pipeline and pending_clip is not None:
+        start_clip(pending_clip)
+
+def on_bus_segment_done(message):
+    # Parked playbins are PAUSED and can't finish a segment; only loop the active one
+    if message.src == pipeline and current_clip is not None:
+        log.debug("BUS: SEGMENT_DONE - looping '%s'", current_clip['name'])
+        seek_to_clip(current_clip, LOOP_SEEK_FLAGS)
+
+BUS_HANDLERS = {
+    Gst.MessageType.ERROR: on_bus_error,
+    Gst.MessageType.WARNING: on_bus_warning,
+    Gst.MessageType.EOS: on_bus_eos,
+    Gst.MessageType.STATE_CHANGED: on_bus_state_changed,
+    Gst.MessageType.ASYNC_DONE: on_bus_async_done,
+    Gst.MessageType.SEGMENT_DONE: on_bus_segment_done,
+}
 
 def on_bus_message(bus, message):
-    """Handle GStreamer bus messages for debugging"""
-    t = message.type
-    if t == Gst.MessageType.ERROR:
-        err, debug = message.parse_error()
-        print(f"BUS ERROR: {err}")
-        print(f"  Debug: {debug}")
-    elif t == Gst.MessageType.WARNING:
-        err, debug = message.parse_warning()
-        print(f"BUS WARNING: {err}")
-    elif t == Gst.MessageType.EOS:
-        print("BUS: End of stream")
-    elif t == Gst.MessageType.STATE_CHANGED:
-        if message.src == pipeline:
-            old, new, pending = message.parse_state_changed()
-            print(f"BUS: Pipeline state: {old.value_nick} -> {new.value_nick} (pending: {pending.value_nick})")
-    elif t == Gst.MessageType.ASYNC_DONE:
-        print("BUS: ASYNC_DONE - pipeline is ready")
-    
+    """Dispatch GStreamer bus messages to their handler, if any"""
+    handler = BUS_HANDLERS.get(message.type)
+    if handler is not None:
+        handler(message)
     return True
 
-# Set up bus watch
-bus = pipeline.get_bus()
-bus.add_signal_watch()
-bus.connect("message", on_bus_message)
+# Set up bus watches
+pipelines = set(players.values())
+for player in pipelines:
+    bus = player.get_bus()
+    bus.add_signal_watch()
+    bus.connect("message", on_bus_message)
 
-# Start playing initial file - go to PAUSED first, then PLAYING
-print("\n=== Initial startup ===")
-print("Setting to PAUSED")
-pipeline.set_state(Gst.State.PAUSED)
-ret, state, pending = pipeline.get_state(5 * Gst.SECOND)
-print(f"After PAUSED: {state.value_nick}")
+# Preroll every file at once, then start playing the initial file
+log.info("=== Initial startup ===")
+log.info("Setting %d pipelines to PAUSED", len(pipelines))
+for player in pipelines:
+    player.set_state(Gst.State.PAUSED)
+for player in pipelines:
+    ret, state, pending = player.get_state(5 * Gst.SECOND)
+    log.info("After PAUSED: %s %s", player.get_name(), state.value_nick)
 
-print("Setting to PLAYING")
+log.info("Setting to PLAYING")
 pipeline.set_state(Gst.State.PLAYING)
-ret, state, pending = pipeline.get_state(1 * Gst.SECOND)
-print(f"After PLAYING: {state.value_nick}")
-print("=== Startup complete ===\n")
+log.info("=== Startup complete ===")
+
+# -------------------------------
+# Trigger Coalescing
+# -------------------------------
+# Repeats of the same clip closer together than this are dropped (key repeat, mashing)
+RETRIGGER_WINDOW_NS = 50_000_000
+pending_trigger = None
+last_trigger_clip = None
+last_trigger_ns = 0
+
+def queue_trigger(clip):
+    """
+    Schedule show_clip for clip through a single idle slot. A burst of triggers
+    collapses into one call for the latest clip, and repeats of the same clip
+    inside RETRIGGER_WINDOW_NS are dropped, so hammering a key doesn't issue a
+    flushing seek per event that keeps aborting the decoder.
+    """
+    global pending_trigger, last_trigger_clip, last_trigger_ns
+
+    now = time.monotonic_ns()
+    if clip is last_trigger_clip and now - last_trigger_ns < RETRIGGER_WINDOW_NS:
+        log.debug("  Dropping retrigger of '%s'", clip['name'])
+        return
+    last_trigger_clip = clip
+    last_trigger_ns = now
+
+    if pending_trigger is None:
+        GLib.idle_add(fire_trigger)
+    pending_trigger = clip
+
+def fire_trigger():
+    """Idle callback: show the most recently queued clip."""
+    global pending_trigger
+
+    clip = pending_trigger
+    pending_trigger = None
+    show_clip(clip)
+    return False
 
 # -------------------------------
 # Keyboard Event Handling
 # -------------------------------
+# Map each debug key to its clip once; the first clip listed for a key wins
+keypress_map = {}
+for c in clips_config:
+    if c.get('debug_keypress'):
+        keypress_map.setdefault(c['debug_keypress'], c)
+
 def on_key_press(widget, event):
     key = Gdk.keyval_name(event.keyval)
-    print(f"\nKey pressed: {key}")
-
-    matched = False
-    for clip in clips_config:
-        dbg = clip.get('debug_keypress')
-        if dbg and key == dbg:
-            print(f"Matched debug keypress for clip '{clip['name']}'")
-            show_clip(clip)
-            matched = True
-            break
-    if not matched:
-        print(f"No debug keypress matched")
+    log.debug("Key pressed: %s", key)
+
+    clip = keypress_map.get(key)
+    if clip is not None:
+        log.debug("Matched debug keypress for clip '%s'", clip['name'])
+        queue_trigger(clip)
+    else:
+        log.debug("No debug keypress matched for %s", key)
 
 win.connect("key-press-event", on_key_press)
 
+# -------------------------------
+# Shutdown
+# -------------------------------
+def shutdown(*args):
+    """Stop every pipeline and leave the GTK main loop."""
+    log.info("Shutting down")
+    for player in pipelines:
+        player.set_state(Gst.State.NULL)
+    Gtk.main_quit()
+    return GLib.SOURCE_REMOVE
+
+win.connect("destroy", shutdown)
+# Handle signals on the main loop itself; Python's own handlers would only run
+# once Gtk.main() happened to return to the interpreter
+GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, shutdown)
+GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, shutdown)
+
 # -------------------------------
 # Start GTK Main Loop
 # -------------------------------